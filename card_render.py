@@ -0,0 +1,130 @@
+# Card rasterization, kept out of the Streamlit script so worker processes
+# can import it by name without re-running the UI.
+from io import BytesIO
+
+import numpy as np
+import fitz  # PyMuPDF
+from PIL import Image
+
+
+# ============================================================
+# CONTENT-AWARE TRIM
+# ============================================================
+
+# detection always runs at 72 DPI, so its matrix is shared by every card
+_DETECT_ZOOM = 1.0
+_DETECT_MATRIX = fitz.Matrix(_DETECT_ZOOM, _DETECT_ZOOM)
+
+def _trim_bbox(arr, bg_threshold):
+    # arr is an (h, w, n) uint8 view; returns None when everything is background
+    if arr.shape[2] == 1:
+        mask = arr[:, :, 0] < bg_threshold
+    else:
+        mask = (arr[:, :, :3] < bg_threshold).any(axis=2)
+
+    cols = mask.any(axis=0)
+    rows = mask.any(axis=1)
+
+    if not cols.any():
+        return None
+
+    min_x = int(np.argmax(cols))
+    max_x = len(cols) - 1 - int(np.argmax(cols[::-1]))
+    min_y = int(np.argmax(rows))
+    max_y = len(rows) - 1 - int(np.argmax(rows[::-1]))
+
+    return min_x, min_y, max_x, max_y
+
+
+def _clip_from_detection(arr, base_clip, detect_zoom, bg_threshold):
+    # arr is the RGB detection raster covering base_clip at detect_zoom
+    h, w = arr.shape[:2]
+
+    bbox = _trim_bbox(arr, bg_threshold)
+    if bbox is None or bbox == (0, 0, w - 1, h - 1):
+        # nothing to trim (blank half, or art that fills the whole half)
+        return base_clip
+
+    min_x, min_y, max_x, max_y = bbox
+
+    # bounds found at low DPI may be slightly tight; pad by one pixel
+    inv = 1.0 / detect_zoom
+    x0, y0, x1, y1 = base_clip
+
+    clip = fitz.Rect(
+        x0 + (min_x - 1) * inv,
+        y0 + (min_y - 1) * inv,
+        x0 + (max_x + 2) * inv,
+        y0 + (max_y + 2) * inv
+    )
+    return clip & base_clip
+
+
+def compute_trimmed_clips(page, bg_threshold=250):
+    # a low-resolution render locates the content to within ~1pt; it stays
+    # RGB so pale tints (cream, ivory) still count as content when any
+    # channel is below the threshold. The whole card is rendered once and
+    # the raster split into its two halves.
+    card_w, card_h = page.rect.width, page.rect.height
+    half = card_w / 2
+
+    pix = page.get_pixmap(matrix=_DETECT_MATRIX, clip=fitz.Rect(0, 0, card_w, card_h),
+                          colorspace=fitz.csRGB, alpha=False)
+
+    arr = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    split = int(round(half * _DETECT_ZOOM))
+
+    clip_L = _clip_from_detection(arr[:, :split], fitz.Rect(0, 0, half, card_h),
+                                  _DETECT_ZOOM, bg_threshold)
+    clip_R = _clip_from_detection(arr[:, split:], fitz.Rect(half, 0, card_w, card_h),
+                                  _DETECT_ZOOM, bg_threshold)
+    return clip_L, clip_R
+
+
+def render_clip(page, clip, zoom, slot_size=None):
+    # when the half is shrunk to fit its slot, render only the pixels the
+    # slot can show at the target DPI instead of always using the full zoom
+    if slot_size is not None:
+        slot_w, slot_h = slot_size
+        zoom *= min(1.0, slot_w / clip.width, slot_h / clip.height)
+
+    # full-colour render of the trimmed area only; the zoom is per half,
+    # so its matrix is built here rather than cached
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=fitz.csRGB, alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv)
+
+
+def encode_half(im, jpeg_quality=85, max_colors=256):
+    # photographic artwork is embedded as JPEG bytes; flat line art (few
+    # distinct colours) stays lossless as raw RGB plus its size, which
+    # ReportLab Flate-compresses once when writing the PDF
+    if jpeg_quality is None or im.getcolors(maxcolors=max_colors) is not None:
+        return im.tobytes(), im.size
+
+    buf = BytesIO()
+    # optimize=True adds a second Huffman pass for a few percent of size
+    im.save(buf, "JPEG", quality=jpeg_quality, optimize=False)
+    return buf.getvalue()
+
+
+def payload_size(payload):
+    # bytes held by one encode_half result
+    if isinstance(payload, tuple):
+        return len(payload[0])
+    return len(payload)
+
+
+# ============================================================
+# PER-CARD RENDERING (runs in worker processes)
+# ============================================================
+
+def render_card(card_bytes, zoom, slot_size, jpeg_quality):
+    with fitz.open(stream=card_bytes, filetype="pdf") as card_pdf:
+        page = card_pdf[0]
+
+        clip_L, clip_R = compute_trimmed_clips(page)
+
+        im_L = render_clip(page, clip_L, zoom, slot_size)
+        im_R = render_clip(page, clip_R, zoom, slot_size)
+
+    return encode_half(im_L, jpeg_quality), encode_half(im_R, jpeg_quality)
@@ -1,51 +1,61 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
 import streamlit as st
 from io import BytesIO
 import fitz  # PyMuPDF
+from PIL import Image
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib.pagesizes import A4
 
+from card_render import payload_size, render_card
+
 
 # ============================================================
 # TEMPLATE ANALYSIS (Avery or any PDF with rectangles)
 # ============================================================
 
 def detectar_slots_template(template_bytes):
-    doc = fitz.open(stream=template_bytes, filetype="pdf")
-    page = doc[0]
-    page_rect = page.rect
+    # the template is parsed exactly once; only its geometry outlives the document
+    with fitz.open(stream=template_bytes, filetype="pdf") as doc:
+        page = doc[0]
+        page_rect = page.rect
+        drawings = page.get_drawings()
 
-    drawings = page.get_drawings()
-    rects = []
+    # one pass: filter small shapes and bucket the rest by rounded size
+    buckets = {}
 
     for d in drawings:
         r = d.get("rect")
         if r and r.width > 20 and r.height > 20:
-            rects.append(r)
+            key = (round(r.width, 1), round(r.height, 1))
+            buckets.setdefault(key, []).append(r)
 
-    if not rects:
+    if not buckets:
         raise RuntimeError("No card rectangles found in the template PDF.")
 
-    from collections import Counter, defaultdict
-
-    size_counter = Counter((round(r.width, 1), round(r.height, 1)) for r in rects)
-    main_size, _ = size_counter.most_common(1)[0]
-
-    card_rects = [r for r in rects
-                  if (round(r.width, 1), round(r.height, 1)) == main_size]
+    main_size = max(buckets, key=lambda k: len(buckets[k]))
+    card_rects = buckets[main_size]
 
     if len(card_rects) < 2:
         raise RuntimeError("Not enough card rectangles in template.")
 
-    rows_dict = defaultdict(list)
-    for r in card_rects:
-        key_y = round(r.y0, 1)
-        rows_dict[key_y].append(r)
-
-    row_keys = sorted(rows_dict.keys())
+    # group into rows by y0 with a tolerance, so sub-point jitter in the
+    # template does not split one row into several
+    tol = main_size[1] * 0.1
     rows = []
-    for y in row_keys:
-        rows.append(sorted(rows_dict[y], key=lambda rc: rc.x0))
+    for r in sorted(card_rects, key=lambda rc: rc.y0):
+        if not rows or r.y0 - rows[-1][0].y0 > tol:
+            rows.append([])
+        rows[-1].append(r)
+
+    rows = [sorted(row, key=lambda rc: rc.x0) for row in rows]
 
     slots_flat = [rc for row in rows for rc in row]
     return page_rect, slots_flat, rows
@@ -58,53 +68,23 @@ def rect_to_reportlab_coords(r, page_height):
 
 
 # ============================================================
-# CONTENT-AWARE TRIM
+# IMAGE HAND-OFF TO REPORTLAB
 # ============================================================
 
-def compute_trimmed_clip(page, base_clip, zoom, bg_threshold=250):
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, clip=base_clip, alpha=False)
-
-    w, h, n = pix.width, pix.height, pix.n
-    samples = pix.samples
-
-    min_x, min_y = w, h
-    max_x, max_y = -1, -1
-
-    for y in range(h):
-        row_idx = y * w * n
-        for x in range(w):
-            idx = row_idx + x * n
-            r = samples[idx]
-            g = samples[idx + 1] if n > 1 else r
-            b = samples[idx + 2] if n > 2 else r
-
-            if r < bg_threshold or g < bg_threshold or b < bg_threshold:
-                if x < min_x: min_x = x
-                if x > max_x: max_x = x
-                if y < min_y: min_y = y
-                if y > max_y: max_y = y
-
-    if max_x < 0:
-        return base_clip
-
-    inv = 1.0 / zoom
-    x0, y0, x1, y1 = base_clip
-
-    return fitz.Rect(
-        x0 + min_x * inv,
-        y0 + min_y * inv,
-        x0 + (max_x + 1) * inv,
-        y0 + (max_y + 1) * inv
-    )
+def to_image_reader(payload):
+    # payloads come from card_render.encode_half: JPEG bytes, or raw RGB
+    # bytes plus size for lossless halves
+    if isinstance(payload, tuple):
+        raw, size = payload
+        return ImageReader(Image.frombuffer("RGB", size, raw, "raw", "RGB", 0, 1))
+    return ImageReader(BytesIO(payload))
 
 
 # ============================================================
 # FIT + CENTER
 # ============================================================
 
-def fit_and_center(slot_x, slot_y, slot_w, slot_h, pix, margin_factor=0.95):
-    img_w, img_h = pix.width, pix.height
+def fit_and_center(slot_x, slot_y, slot_w, slot_h, img_w, img_h, margin_factor=0.95):
 
     scale = min(slot_w / img_w, slot_h / img_h) * margin_factor
 
@@ -118,73 +98,183 @@ def fit_and_center(slot_x, slot_y, slot_w, slot_h, pix, margin_factor=0.95):
 
 
 # ============================================================
-# MODE 1 — USING A TEMPLATE (Avery)
+# PARALLEL RENDERING
 # ============================================================
 
-def gerar_pdf_final(template_bytes, card_files):
-    page_rect, slots_flat, rows = detectar_slots_template(template_bytes)
-    page_width, page_height = page_rect.width, page_rect.height
+def worker_count(cap=4):
+    # os.cpu_count() reports the host inside containers; the affinity mask is
+    # closer to what we may use, and the cap covers CPU quotas it cannot see
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    return max(1, min(n, cap))
+
+
+def card_pool():
+    # never fork the threaded Streamlit server; workers import card_render
+    # by name, so they do not depend on this script's __main__ module
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=worker_count(), mp_context=ctx)
+
+
+def _iter_card_bytes(card_files):
+    # rewind first: an upload may already have been read by an earlier run
+    for f in card_files:
+        f.seek(0)
+        yield f.read()
+
+
+class _RenderCache:
+    # LRU of rendered card halves, keyed by card content and render settings
+    # and bounded by the total size of the payloads
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            halves = self._items.get(key)
+            if halves is not None:
+                self._items.move_to_end(key)
+            return halves
+
+    def put(self, key, halves):
+        size = sum(payload_size(payload) for payload in halves)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= sum(payload_size(payload) for payload in old)
+            self._items[key] = halves
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= sum(payload_size(payload) for payload in evicted)
+
+
+@st.cache_resource(show_spinner=False)
+def _render_cache():
+    # survives Streamlit reruns and is shared by every session, so it is
+    # capped by bytes to stay well inside a Streamlit Cloud container
+    return _RenderCache(max_bytes=64 << 20)
+
+
+def _resolve(cache, in_flight, key, halves):
+    if isinstance(halves, Future):
+        halves = halves.result()
+        cache.put(key, halves)
+        in_flight.pop(key, None)
+    return key, halves
+
+
+def render_cards(pool, card_files, zoom, slot_size, jpeg_quality, max_pending=None):
+    # read uploads lazily and keep only a few cards in flight, so memory
+    # stays bounded by the pool size instead of the number of cards
+    if max_pending is None:
+        max_pending = 2 * worker_count()
+
+    cache = _render_cache()
+    # duplicates of a card still being rendered share its future
+    in_flight = {}
+    pending = deque()
+    for card_bytes in _iter_card_bytes(card_files):
+        key = (hashlib.blake2b(card_bytes, digest_size=16).digest(), zoom, slot_size, jpeg_quality)
+        halves = cache.get(key) or in_flight.get(key)
+        if halves is None:
+            halves = pool.submit(render_card, card_bytes, zoom, slot_size, jpeg_quality)
+            in_flight[key] = halves
+        pending.append((key, halves))
+        if len(pending) >= max_pending:
+            yield _resolve(cache, in_flight, *pending.popleft())
+
+    while pending:
+        yield _resolve(cache, in_flight, *pending.popleft())
 
-    card_bytes_list = [f.read() for f in card_files]
-    total_cards = len(card_bytes_list)
-    card_idx = 0
 
-    output = BytesIO()
-    c = canvas.Canvas(output, pagesize=(page_width, page_height))
+# ============================================================
+# PAGE COMPOSITION
+# ============================================================
+
+def draw_cards(c, slot_rows, rendered, total_cards, max_readers=8):
+    # slot_rows holds one (left, right) pair of ReportLab (x, y, w, h) slots
+    # per row, precomputed once per job
+    card_idx = 0
 
-    zoom = 300 / 72
+    # small LRU so a card repeated in the batch reuses its ImageReaders
+    # instead of wrapping the halves again; kept short because each reader
+    # holds on to its decoded RGB data once drawn
+    readers = OrderedDict()
 
     while card_idx < total_cards:
-        # blank page (no template drawn)
-
-        for row_rects in rows:
+        for left_slot, right_slot in slot_rows:
             if card_idx >= total_cards:
                 break
 
-            if len(row_rects) < 2:
-                continue
+            key, (payload_L, payload_R) = next(rendered)
 
-            left_slot = row_rects[0]
-            right_slot = row_rects[1]
+            pair = readers.pop(key, None)
+            if pair is None:
+                pair = to_image_reader(payload_L), to_image_reader(payload_R)
+            readers[key] = pair
+            if len(readers) > max_readers:
+                readers.popitem(last=False)
 
-            card_pdf = fitz.open(stream=card_bytes_list[card_idx], filetype="pdf")
-            page = card_pdf[0]
+            img_L, img_R = pair
 
-            card_w, card_h = page.rect.width, page.rect.height
-            half = card_w / 2
+            xL, yL, wL, hL = fit_and_center(*left_slot, *img_L.getSize())
+            xR, yR, wR, hR = fit_and_center(*right_slot, *img_R.getSize())
 
-            clip_L = compute_trimmed_clip(page, fitz.Rect(0, 0, half, card_h), zoom)
-            clip_R = compute_trimmed_clip(page, fitz.Rect(half, 0, card_w, card_h), zoom)
+            c.drawImage(img_L, xL, yL, width=wL, height=hL)
+            c.drawImage(img_R, xR, yR, width=wR, height=hR)
 
-            mat = fitz.Matrix(zoom, zoom)
-            pix_L = page.get_pixmap(matrix=mat, clip=clip_L)
-            pix_R = page.get_pixmap(matrix=mat, clip=clip_R)
+            card_idx += 1
 
-            img_L = ImageReader(BytesIO(pix_L.tobytes("png")))
-            img_R = ImageReader(BytesIO(pix_R.tobytes("png")))
+        c.showPage()
 
-            xLslot, yLslot, wLslot, hLslot = rect_to_reportlab_coords(left_slot, page_height)
-            xRslot, yRslot, wRslot, hRslot = rect_to_reportlab_coords(right_slot, page_height)
 
-            xL, yL, wL, hL = fit_and_center(xLslot, yLslot, wLslot, hLslot, pix_L)
-            xR, yR, wR, hR = fit_and_center(xRslot, yRslot, wRslot, hRslot, pix_R)
+# ============================================================
+# MODE 1 — USING A TEMPLATE (Avery)
+# ============================================================
 
-            c.drawImage(img_L, xL, yL, width=wL, height=hL)
-            c.drawImage(img_R, xR, yR, width=wR, height=hR)
+def gerar_pdf_final(template_bytes, card_files, output_path, jpeg_quality=85, dpi=200):
+    page_rect, slots_flat, rows = detectar_slots_template(template_bytes)
+    page_width, page_height = page_rect.width, page_rect.height
 
-            card_idx += 1
+    slot_rows = [
+        (rect_to_reportlab_coords(row[0], page_height),
+         rect_to_reportlab_coords(row[1], page_height))
+        for row in rows if len(row) >= 2
+    ]
 
-        c.showPage()
+    if not slot_rows:
+        raise RuntimeError("No template row has room for both halves of a card.")
+
+    c = canvas.Canvas(output_path, pagesize=(page_width, page_height))
+
+    zoom = dpi / 72
+    # template slots all share the main card size
+    slot_size = slot_rows[0][0][2:]
+
+    with card_pool() as pool:
+        rendered = render_cards(pool, card_files, zoom, slot_size, jpeg_quality)
+        # blank pages (no template drawn)
+        draw_cards(c, slot_rows, rendered, len(card_files))
 
     c.save()
-    return output.getvalue()
+    return output_path
 
 
 # ============================================================
 # MODE 2 — A4 AUTOMÁTICO (sem template)
 # ============================================================
 
-def gerar_pdf_a4(card_files):
+def gerar_pdf_a4(card_files, output_path, jpeg_quality=85, dpi=200):
     page_width, page_height = A4
     rows = 5
     cols = 2
@@ -198,64 +288,32 @@ def gerar_pdf_a4(card_files):
     slot_w = usable_w / cols
     slot_h = usable_h / rows
 
-    card_bytes_list = [f.read() for f in card_files]
-    total_cards = len(card_bytes_list)
-    card_idx = 0
-
-    output = BytesIO()
-    c = canvas.Canvas(output, pagesize=A4)
-
-    zoom = 300 / 72
-
-    while card_idx < total_cards:
-
-        for r in range(rows):
-            if card_idx >= total_cards:
-                break
-
-            y_top = page_height - margin_y - r * slot_h
-            y_bottom = y_top - slot_h
-
-            xLslot, yLslot, wLslot, hLslot = (margin_x, y_bottom, slot_w, slot_h)
-            xRslot, yRslot, wRslot, hRslot = (margin_x + slot_w, y_bottom, slot_w, slot_h)
+    slot_rows = []
+    for r in range(rows):
+        y_bottom = page_height - margin_y - (r + 1) * slot_h
+        slot_rows.append(((margin_x, y_bottom, slot_w, slot_h),
+                          (margin_x + slot_w, y_bottom, slot_w, slot_h)))
 
-            card_pdf = fitz.open(stream=card_bytes_list[card_idx], filetype="pdf")
-            page = card_pdf[0]
+    c = canvas.Canvas(output_path, pagesize=A4)
 
-            cw, ch = page.rect.width, page.rect.height
-            half = cw / 2
+    zoom = dpi / 72
 
-            clip_L = compute_trimmed_clip(page, fitz.Rect(0, 0, half, ch), zoom)
-            clip_R = compute_trimmed_clip(page, fitz.Rect(half, 0, cw, ch), zoom)
-
-            mat = fitz.Matrix(zoom, zoom)
-            pix_L = page.get_pixmap(matrix=mat, clip=clip_L)
-            pix_R = page.get_pixmap(matrix=mat, clip=clip_R)
-
-            img_L = ImageReader(BytesIO(pix_L.tobytes("png")))
-            img_R = ImageReader(BytesIO(pix_R.tobytes("png")))
-
-            xL, yL, wL, hL = fit_and_center(xLslot, yLslot, wLslot, hLslot, pix_L)
-            xR, yR, wR, hR = fit_and_center(xRslot, yRslot, wRslot, hRslot, pix_R)
-
-            c.drawImage(img_L, xL, yL, width=wL, height=hL)
-            c.drawImage(img_R, xR, yR, width=wR, height=hR)
-
-            card_idx += 1
-
-        c.showPage()
+    with card_pool() as pool:
+        rendered = render_cards(pool, card_files, zoom, (slot_w, slot_h), jpeg_quality)
+        draw_cards(c, slot_rows, rendered, len(card_files))
 
     c.save()
-    return output.getvalue()
+    return output_path
 
 
 # ============================================================
 # STREAMLIT UI
 # ============================================================
 
-st.title("IWBF Player Card Merger")
+def main():
+    st.title("IWBF Player Card Merger")
 
-st.markdown("""
+    st.markdown("""
 Upload **player card PDFs**.  
 Optionally upload a **business card template PDF**.  
 
@@ -265,39 +323,55 @@ Optionally upload a **business card template PDF**.
 - If you are using Avery business card paper, **[click here to find and download the official template](https://www.avery.com/templates/category/business-cards)**.
 """)
 
-template = st.file_uploader("Optional: Upload a business card template PDF (e.g., Avery Template 5371 Business Cards)", type=["pdf"])
-cards = st.file_uploader("Upload all the player cards you want to print", type=["pdf"], accept_multiple_files=True)
-
-# progress + upload ready logic
-upload_ready = False
-
-if cards:
-    total = len(cards)
-    progress = st.progress(0)
-    for i, f in enumerate(cards):
-        progress.progress((i+1)/total)
-    progress.empty()
-
-    st.success(f"{len(cards)} cards uploaded successfully.")
-    upload_ready = True
-else:
-    st.warning("Upload the player cards before continuing.")
-
-
-# button disabled until upload is done
-if st.button("Generate PDF", disabled=not upload_ready):
-    try:
-        if template:
-            pdf = gerar_pdf_final(template.read(), cards)
-        else:
-            pdf = gerar_pdf_a4(cards)
-
-        st.success("PDF generated!")
-        st.download_button(
-            "Download PDF",
-            data=pdf,
-            file_name="merged_cards_output.pdf",
-            mime="application/pdf"
-        )
-    except Exception as e:
-        st.error(f"Error: {e}")
+    template = st.file_uploader("Optional: Upload a business card template PDF (e.g., Avery Template 5371 Business Cards)", type=["pdf"])
+    cards = st.file_uploader("Upload all the player cards you want to print", type=["pdf"], accept_multiple_files=True)
+    jpeg_quality = st.slider("JPEG quality for photographic card artwork (line art is kept lossless)", 50, 100, 85)
+    dpi = st.slider("Render DPI", 150, 400, 200,
+                    help="200 DPI is indistinguishable from 300 on business-card prints; "
+                         "above 300 DPI there is no visible benefit on standard printers.")
+
+    # progress + upload ready logic
+    upload_ready = False
+
+    if cards:
+        total = len(cards)
+        progress = st.progress(0)
+        for i, f in enumerate(cards):
+            progress.progress((i+1)/total)
+        progress.empty()
+
+        st.success(f"{len(cards)} cards uploaded successfully.")
+        upload_ready = True
+    else:
+        st.warning("Upload the player cards before continuing.")
+
+    # button disabled until upload is done
+    if st.button("Generate PDF", disabled=not upload_ready):
+        # the PDF is written to disk instead of being held in memory twice
+        # (once as the output buffer, once as the returned bytes)
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            if template:
+                template.seek(0)
+                gerar_pdf_final(template.read(), cards, pdf_path, jpeg_quality, dpi)
+            else:
+                gerar_pdf_a4(cards, pdf_path, jpeg_quality, dpi)
+
+            st.success("PDF generated!")
+            with open(pdf_path, "rb") as pdf:
+                st.download_button(
+                    "Download PDF",
+                    data=pdf,
+                    file_name="merged_cards_output.pdf",
+                    mime="application/pdf"
+                )
+        except Exception as e:
+            st.error(f"Error: {e}")
+        finally:
+            os.remove(pdf_path)
+
+
+# spawned workers re-import this file as __mp_main__; only Streamlit runs the UI
+if __name__ == "__main__":
+    main()